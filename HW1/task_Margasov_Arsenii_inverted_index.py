@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 """InvertedIndex implemented here"""
-from struct import pack, unpack, calcsize
+from struct import pack, unpack, unpack_from, calcsize, error as StructError
+import codecs
+import itertools
+import os
 import sys
+import time
+import zlib
 from io import TextIOWrapper
 # import re
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, \
@@ -12,6 +17,40 @@ from collections import defaultdict
 # RE_SPLIT_PATTERN = r"\s+"
 DEFAULT_DATASET_PATH = "./resources/tiny_wikipedia_sample"
 DEFAULT_INVERTED_INDEX_STORE_PATH = "inverted.index"
+QUERY_ENCODINGS = ("utf-8", "cp1251")
+ENCODING_DETECTION_SAMPLE_SIZE = 1 << 16
+DEFAULT_SHARD_TIMEOUT = 60.0
+DEFAULT_SHARD_CHUNK_SIZE = 1000
+INDEX_MAGIC = b"INVIDX"
+INDEX_VERSION = 1
+INDEX_HEADER_FORMAT = ">6sHQI"
+SHARDS_MANIFEST_SUFFIX = ".manifest"
+
+
+def _atomic_write(filepath: str, data: bytes):
+    import tempfile
+
+    dirpath = os.path.dirname(os.path.abspath(filepath))
+    fd, tmp_filepath = tempfile.mkstemp(dir=dirpath, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        # mkstemp creates 0600 file, give it the mode open() would
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_filepath, 0o666 & ~umask)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.unlink(tmp_filepath)
+        raise
+    # make the rename itself durable
+    dir_fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 
 class StoragePolicy:
@@ -79,9 +118,16 @@ class StoragePolicy:
 #             return InvertedIndex(term_doc_id=json.load(file))
 
 
+class CorruptedIndexError(ValueError):
+    """
+    Raised when stored InvertedIndex is truncated, has wrong checksum or version
+    """
+
+
 class BinaryStoragePolicy(StoragePolicy):
     """
-    BinaryStoragePolicy with struct
+    BinaryStoragePolicy with struct, file starts with header:
+    magic, version, payload length and crc32 of payload
     """
 
     # DEFAULT_NUM_BINARY_ENCODING = "i"
@@ -92,22 +138,25 @@ class BinaryStoragePolicy(StoragePolicy):
 
         Args:
             word_to_docs_mapping: internal mapping of InvertedIndex
-            filepath: path to dump
+            filepath: path to dump, file is replaced atomically
 
         Returns:
             None
         """
         print(f"dump inverted index to {filepath}", file=sys.stderr)
-        with open(filepath, 'wb') as file:
-            length_of_dict = len(word_to_docs_mapping)
-            file.write(pack(">i", length_of_dict))
-            for term, ids in word_to_docs_mapping.items():
-                term_encoded = term.encode()
-                length_of_term = len(term_encoded)
-                file.write(pack(">H", length_of_term))
-                file.write(pack(">" + str(length_of_term) + "s", term_encoded))
-                file.write(pack(">H", len(ids)))
-                file.write(pack(">" + str(len(ids)) + "H", *list(ids)))
+        payload = bytearray()
+        length_of_dict = len(word_to_docs_mapping)
+        payload += pack(">i", length_of_dict)
+        for term, ids in word_to_docs_mapping.items():
+            term_encoded = term.encode()
+            length_of_term = len(term_encoded)
+            payload += pack(">H", length_of_term)
+            payload += pack(">" + str(length_of_term) + "s", term_encoded)
+            payload += pack(">H", len(ids))
+            payload += pack(">" + str(len(ids)) + "H", *list(ids))
+        header = pack(INDEX_HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION,
+                      len(payload), zlib.crc32(payload))
+        _atomic_write(filepath, header + payload)
 
     @staticmethod
     def load(filepath: str):
@@ -118,25 +167,64 @@ class BinaryStoragePolicy(StoragePolicy):
 
         Returns:
             InvertedIndex
+
+        Raises:
+            CorruptedIndexError: if file is damaged
         """
         print(f"load inverted index from filepath {filepath}", file=sys.stderr)
-        term_doc_id = defaultdict(set)
         with open(filepath, 'rb') as file:
-            length_of_dict = file.read(calcsize(">i"))
-            length_of_dict = unpack(">i", length_of_dict)[0]
-            for _ in range(length_of_dict):
-                length_of_term = file.read(calcsize(">H"))
-                length_of_term = unpack(">H", length_of_term)[0]
-                term = unpack(">" + str(length_of_term) + "s",
-                              file.read(length_of_term))[0]
-                term = term.decode()
-                length_of_ids = file.read(calcsize(">H"))
-                length_of_ids = unpack(">H", length_of_ids)[0]
-                ids = file.read(length_of_ids * calcsize(">H"))
-                ids = set(unpack(">" + str(length_of_ids) + "H", ids))
-                term_doc_id[term] = ids
-
-            return InvertedIndex(term_doc_id=term_doc_id)
+            data = file.read()
+        if data.startswith(INDEX_MAGIC):
+            payload = BinaryStoragePolicy._check_header(data, filepath)
+        else:
+            # index dumped before header was introduced
+            payload = memoryview(data)
+        try:
+            term_doc_id = BinaryStoragePolicy._parse_payload(payload)
+        except (StructError, UnicodeDecodeError) as e:
+            raise CorruptedIndexError(f"can't parse inverted index {filepath}: {e}") from e
+        return InvertedIndex(term_doc_id=term_doc_id)
+
+    @staticmethod
+    def _check_header(data: bytes, filepath: str) -> memoryview:
+        header_size = calcsize(INDEX_HEADER_FORMAT)
+        if len(data) < header_size:
+            raise CorruptedIndexError(f"inverted index {filepath} has truncated header")
+        _, version, length_of_payload, checksum = unpack_from(INDEX_HEADER_FORMAT, data)
+        if version != INDEX_VERSION:
+            raise CorruptedIndexError(
+                f"inverted index {filepath} has unsupported version {version}"
+            )
+        payload = memoryview(data)[header_size:]
+        if len(payload) != length_of_payload:
+            raise CorruptedIndexError(
+                f"inverted index {filepath} has {len(payload)} bytes of payload, "
+                f"expected {length_of_payload}"
+            )
+        if zlib.crc32(payload) != checksum:
+            raise CorruptedIndexError(f"inverted index {filepath} has wrong checksum")
+        return payload
+
+    @staticmethod
+    def _parse_payload(payload: memoryview) -> defaultdict:
+        term_doc_id = defaultdict(set)
+        offset = 0
+        length_of_dict = unpack_from(">i", payload, offset)[0]
+        offset += calcsize(">i")
+        for _ in range(length_of_dict):
+            length_of_term = unpack_from(">H", payload, offset)[0]
+            offset += calcsize(">H")
+            term = unpack_from(">" + str(length_of_term) + "s", payload, offset)[0]
+            term = term.decode()
+            offset += length_of_term
+            length_of_ids = unpack_from(">H", payload, offset)[0]
+            offset += calcsize(">H")
+            ids = set(unpack_from(">" + str(length_of_ids) + "H", payload, offset))
+            offset += length_of_ids * calcsize(">H")
+            term_doc_id[term] = ids
+        if offset != len(payload):
+            raise StructError(f"{len(payload) - offset} unexpected trailing bytes")
+        return term_doc_id
 
 
 class EncodedFileType(FileType):
@@ -167,11 +255,54 @@ class EncodedFileType(FileType):
             raise ArgumentTypeError(message % args)
 
 
+def positive_float(string: str) -> float:
+    """
+
+    Args:
+        string: argument from command line
+
+    Returns:
+        float > 0
+
+    Raises:
+        ArgumentTypeError: if string is not a positive number
+    """
+    try:
+        value = float(string)
+    except ValueError:
+        value = 0.0
+    if not value > 0:
+        raise ArgumentTypeError(f"expected number > 0, got {string!r}")
+    return value
+
+
+def positive_int(string: str) -> int:
+    """
+
+    Args:
+        string: argument from command line
+
+    Returns:
+        int >= 1
+
+    Raises:
+        ArgumentTypeError: if string is not a positive integer
+    """
+    try:
+        value = int(string)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise ArgumentTypeError(f"expected integer >= 1, got {string!r}")
+    return value
+
+
 class InvertedIndex:
     """InvertedIndex: term -> document_ids"""
 
     def __init__(self, term_doc_id: defaultdict):
         self.term_doc_id = term_doc_id
+        self._encoded_term_doc_id = {}
 
     def __eq__(self, other):
         outcome = (
@@ -200,16 +331,53 @@ class InvertedIndex:
             f"{repr(words)}"
         )
         print(f"query inverted index with request {repr(words)}", file=sys.stderr)
+        return self._intersect(words, self.term_doc_id)
+
+    def query_bytes(self, words: list, encoding: str = "utf-8") -> list:
+        """
+
+        Args:
+            words: list of encoded words to query
+            encoding: encoding of words
+
+        Returns:
+            list of ids of documents
+        """
+        print(f"query inverted index with request {repr(words)}", file=sys.stderr)
+        return self._intersect(words, self.encoded_term_doc_id(encoding))
+
+    def encoded_term_doc_id(self, encoding: str) -> dict:
+        """
+
+        Args:
+            encoding: encoding of terms
+
+        Returns:
+            mapping of encoded term -> document_ids, terms which can't be
+            encoded are skipped
+        """
+        mapping = self._encoded_term_doc_id.get(encoding)
+        if mapping is None:
+            mapping = {}
+            for term, ids in self.term_doc_id.items():
+                try:
+                    mapping[term.encode(encoding)] = ids
+                except UnicodeEncodeError:
+                    continue
+            self._encoded_term_doc_id[encoding] = mapping
+        return mapping
+
+    @staticmethod
+    def _intersect(words: list, mapping) -> list:
         words_set = set(words)
-        intersected_words = words_set & set(self.term_doc_id.keys())
-        if len(words_set) != len(intersected_words):
+        if not all(word in mapping for word in words_set):
             return []
         relevant_ids = set()
-        for term in intersected_words:
+        for term in words_set:
             if len(relevant_ids) == 0:
-                relevant_ids = relevant_ids | set(self.term_doc_id[term])
+                relevant_ids = relevant_ids | set(mapping[term])
             else:
-                relevant_ids = relevant_ids & set(self.term_doc_id[term])
+                relevant_ids = relevant_ids & set(mapping[term])
         return list(relevant_ids)
 
     def dump(self, filepath: str):
@@ -238,6 +406,273 @@ class InvertedIndex:
         return BinaryStoragePolicy.load(filepath)
 
 
+def shard_filepaths(filepath: str, shards_count: int, generation: str) -> list:
+    """
+
+    Args:
+        filepath: filepath of the whole InvertedIndex
+        shards_count: number of shards
+        generation: unique name of the build, so shards of a new build
+            never overwrite shards listed in the current manifest
+
+    Returns:
+        list of filepaths of shards
+    """
+    return [f"{filepath}.{generation}.{shard}" for shard in range(shards_count)]
+
+
+def dump_shards_manifest(filepath: str, filepaths: list):
+    """
+
+    Args:
+        filepath: filepath of the whole InvertedIndex, manifest is stored
+            next to it with SHARDS_MANIFEST_SUFFIX
+        filepaths: filepaths of shards
+
+    Returns:
+        None
+    """
+    import json
+
+    manifest = {
+        "shards_count": len(filepaths),
+        "shards": [os.path.basename(shard_filepath) for shard_filepath in filepaths],
+    }
+    _atomic_write(f"{filepath}{SHARDS_MANIFEST_SUFFIX}", json.dumps(manifest).encode())
+
+
+def load_shards_manifest(filepath: str) -> list:
+    """
+
+    Args:
+        filepath: filepath of the whole InvertedIndex
+
+    Returns:
+        list of filepaths of shards or None if index isn't sharded
+
+    Raises:
+        CorruptedIndexError: if manifest is damaged
+    """
+    import json
+
+    manifest_filepath = f"{filepath}{SHARDS_MANIFEST_SUFFIX}"
+    try:
+        with open(manifest_filepath) as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        raise CorruptedIndexError(f"can't parse shards manifest {manifest_filepath}: {e}") from e
+    shards = manifest.get("shards") if isinstance(manifest, dict) else None
+    if not isinstance(shards, list) or len(shards) != manifest.get("shards_count"):
+        raise CorruptedIndexError(f"shards manifest {manifest_filepath} is inconsistent")
+    dirpath = os.path.dirname(os.fspath(filepath))
+    return [os.path.join(dirpath, shard) for shard in shards]
+
+
+def _serve_shard(filepath: str, connection, encoding=None):
+    try:
+        inverted_index = InvertedIndex.load(filepath)
+    except (OSError, CorruptedIndexError) as e:
+        connection.send(("error", e))
+        return
+    connection.send(("ready", None))
+    while True:
+        queries = connection.recv()
+        if queries is None:
+            break
+        if encoding is None:
+            connection.send(("ok", [inverted_index.query(query) for query in queries]))
+        else:
+            connection.send(("ok", [inverted_index.query_bytes(query, encoding) for query in queries]))
+
+
+class ShardedInvertedIndex:
+    """
+    Coordinator which queries document-partitioned InvertedIndex shards,
+    each shard is loaded once into its own worker process, timeout limits
+    every call of query_many, queries are lists of encoded words if
+    encoding is given
+    """
+
+    SHARD_ERRORS = (TimeoutError, EOFError, OSError, CorruptedIndexError)
+
+    def __init__(self, filepaths: list, timeout: float = DEFAULT_SHARD_TIMEOUT,
+                 encoding: str = None):
+        from multiprocessing import Pipe, Process
+
+        self.filepaths = filepaths
+        self.timeout = timeout
+        self._workers = []
+        for filepath in filepaths:
+            connection, worker_connection = Pipe()
+            process = Process(target=_serve_shard, args=(filepath, worker_connection, encoding), daemon=True)
+            process.start()
+            worker_connection.close()
+            self._workers.append((process, connection))
+        self._ready_shards = set()
+        self._failed_shards = set()
+
+    def _receive(self, shard: int, deadline: float):
+        _, connection = self._workers[shard]
+        if not connection.poll(max(0.0, deadline - time.monotonic())):
+            raise TimeoutError(f"no answer in {self.timeout} seconds")
+        status, payload = connection.recv()
+        if status == "error":
+            raise payload
+        return payload
+
+    def _fail(self, shard: int, error: Exception):
+        print(f"shard {self.filepaths[shard]} failed: {error!r}, results are partial",
+              file=sys.stderr)
+        self._failed_shards.add(shard)
+        process, connection = self._workers[shard]
+        process.terminate()
+        process.join()
+        connection.close()
+
+    def query_many(self, queries: list):
+        """
+
+        Args:
+            queries: list of lists of words
+
+        Returns:
+            list of lists of ids of documents and list of filepaths of shards
+            which failed or timed out, results are partial if it is not empty
+        """
+        deadline = time.monotonic() + self.timeout
+        relevant_ids = [set() for _ in queries]
+        queried_shards = []
+        for shard in range(len(self.filepaths)):
+            if shard in self._failed_shards:
+                continue
+            try:
+                if shard not in self._ready_shards:
+                    # queries are sent only to a loaded worker, which reads them at once
+                    self._receive(shard, deadline)
+                    self._ready_shards.add(shard)
+                self._workers[shard][1].send(queries)
+            except self.SHARD_ERRORS as e:
+                self._fail(shard, e)
+                continue
+            queried_shards.append(shard)
+        for shard in queried_shards:
+            try:
+                shard_relevant_ids = self._receive(shard, deadline)
+            except self.SHARD_ERRORS as e:
+                self._fail(shard, e)
+                continue
+            for query_ids, shard_query_ids in zip(relevant_ids, shard_relevant_ids):
+                query_ids.update(shard_query_ids)
+        failed_shards = [self.filepaths[shard] for shard in sorted(self._failed_shards)]
+        return [list(query_ids) for query_ids in relevant_ids], failed_shards
+
+    def close(self):
+        """
+            Stop worker processes
+        Returns:
+            None
+        """
+        for shard, (process, connection) in enumerate(self._workers):
+            if shard in self._failed_shards:
+                continue
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            process.join(self.timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ReloadableInvertedIndex:
+    """
+    InvertedIndex which can be reloaded from disk in background,
+    queries are served by the old index until the new one is loaded
+    """
+
+    def __init__(self, filepath: str):
+        import threading
+
+        self.filepath = filepath
+        self._stat_key = self._get_stat_key()
+        self._failed_stat_key = None
+        self.inverted_index = InvertedIndex.load(filepath)
+        self._reload_lock = threading.Lock()
+        self._reload_thread = None
+
+    def _get_stat_key(self):
+        stat = os.stat(self.filepath)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def query(self, words: list) -> list:
+        """
+
+        Args:
+            words: list of words to query
+
+        Returns:
+            list of ids of documents
+        """
+        return self.inverted_index.query(words)
+
+    def reload(self) -> 'threading.Thread':
+        """
+            Start loading index from filepath in a background thread, current
+            index is replaced only if new one is loaded without errors
+        Returns:
+            thread doing the reload, join it to wait for the swap
+        """
+        with self._reload_lock:
+            if self._reload_thread is None or not self._reload_thread.is_alive():
+                import threading
+
+                self._reload_thread = threading.Thread(target=self._reload, daemon=True)
+                self._reload_thread.start()
+            return self._reload_thread
+
+    def reload_if_changed(self):
+        """
+            Start reload if file at filepath was replaced since last load,
+            a file which failed to load is skipped until it is changed again
+        Returns:
+            thread doing the reload or None if file wasn't changed or can't
+            be accessed
+        """
+        try:
+            stat_key = self._get_stat_key()
+        except OSError:
+            return None
+        if stat_key in (self._stat_key, self._failed_stat_key):
+            return None
+        return self.reload()
+
+    def _reload(self):
+        try:
+            stat_key = self._get_stat_key()
+        except OSError as e:
+            print(f"reload of inverted index failed, keep serving old one: {e}", file=sys.stderr)
+            return
+        try:
+            inverted_index = InvertedIndex.load(self.filepath)
+        except (OSError, CorruptedIndexError) as e:
+            print(f"reload of inverted index failed, keep serving old one: {e}", file=sys.stderr)
+            self._failed_stat_key = stat_key
+            return
+        self.inverted_index = inverted_index
+        self._stat_key = stat_key
+        self._failed_stat_key = None
+
+
 def load_documents(filepath: str) -> dict:
     """
 
@@ -256,6 +691,46 @@ def load_documents(filepath: str) -> dict:
     return documents
 
 
+def detect_encoding(data: bytes, encodings: tuple = QUERY_ENCODINGS) -> str:
+    """
+
+    Args:
+        data: raw bytes of queries
+        encodings: candidate encodings, the last one is used as a fallback
+
+    Returns:
+        first encoding which can decode the beginning of data
+    """
+    sample = data[:ENCODING_DETECTION_SAMPLE_SIZE]
+    for encoding in encodings[:-1]:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    return encodings[-1]
+
+
+def iter_query_lines(query_file, encoding: str = "auto"):
+    """
+
+    Args:
+        query_file: binary file with queries
+        encoding: encoding of queries, "auto" to detect it by the
+            first ENCODING_DETECTION_SAMPLE_SIZE bytes
+
+    Returns:
+        encoding and iterator over raw lines of query_file, the file is
+        read lazily
+    """
+    head = query_file.read(ENCODING_DETECTION_SAMPLE_SIZE)
+    if encoding == "auto":
+        encoding = detect_encoding(head)
+    if head and not head.endswith(b"\n"):
+        head += query_file.readline()
+    return encoding, itertools.chain(head.splitlines(), query_file)
+
+
 # def load_queries(file: TextIOWrapper) -> list:
 #     """
 #
@@ -290,6 +765,22 @@ def build_inverted_index(documents: dict) -> InvertedIndex:
     return InvertedIndex(term_doc_id=term_doc_id)
 
 
+def build_sharded_inverted_index(documents: dict, shards_count: int) -> list:
+    """
+
+    Args:
+        documents: dict of documents for building InvertedIndex
+        shards_count: number of shards, documents are partitioned by id
+
+    Returns:
+        list of InvertedIndex shards
+    """
+    shards_documents = [{} for _ in range(shards_count)]
+    for idx, text in documents.items():
+        shards_documents[int(idx) % shards_count][idx] = text
+    return [build_inverted_index(shard_documents) for shard_documents in shards_documents]
+
+
 def callback_build(arguments):
     """
 
@@ -299,23 +790,53 @@ def callback_build(arguments):
     Returns:
         process_build(dataset, inverted_index_filepath)
     """
-    return process_build(arguments.dataset_filepath, arguments.inverted_index_filepath)
+    return process_build(arguments.dataset_filepath, arguments.inverted_index_filepath,
+                         arguments.shards)
 
 
-def process_build(dataset_filepath, inverted_index_filepath):
+def process_build(dataset_filepath, inverted_index_filepath, shards_count=1):
     """
 
     Args:
         dataset_filepath: filepath to dataset for processing build
         inverted_index_filepath: filepath for built inverted index
+        shards_count: number of shards, shards are stored next to
+            inverted_index_filepath with build generation and shard number
+            suffix, the shards manifest is switched to them after all shards
+            are dumped and only then shards of previous build are removed
 
     Returns:
 
     """
     print(f"build from {dataset_filepath}, to {inverted_index_filepath}", file=sys.stderr)
     documents = load_documents(dataset_filepath)
-    inverted_index = build_inverted_index(documents)
-    inverted_index.dump(inverted_index_filepath)
+    try:
+        stale_filepaths = load_shards_manifest(inverted_index_filepath) or []
+    except CorruptedIndexError:
+        stale_filepaths = []
+    if shards_count == 1:
+        inverted_index = build_inverted_index(documents)
+        inverted_index.dump(inverted_index_filepath)
+        manifest_filepath = f"{inverted_index_filepath}{SHARDS_MANIFEST_SUFFIX}"
+        if os.path.exists(manifest_filepath):
+            os.unlink(manifest_filepath)
+    else:
+        shards = build_sharded_inverted_index(documents, shards_count)
+        generation = f"{time.time_ns():x}"
+        filepaths = shard_filepaths(inverted_index_filepath, shards_count, generation)
+        try:
+            for shard, filepath in zip(shards, filepaths):
+                shard.dump(filepath)
+            dump_shards_manifest(inverted_index_filepath, filepaths)
+        except BaseException:
+            for filepath in filepaths:
+                if os.path.exists(filepath):
+                    os.unlink(filepath)
+            raise
+    for filepath in stale_filepaths:
+        if os.path.exists(filepath):
+            print(f"remove stale shard {filepath}", file=sys.stderr)
+            os.unlink(filepath)
 
 
 def callback_query(arguments):
@@ -325,14 +846,35 @@ def callback_query(arguments):
         arguments (Namespace): arguments from parser
 
     Returns:
+        if index has shards manifest:
+            process_queries_sharded(filepaths, queries, shard_timeout)
         if query from stdin:
             process_queries_from_stdin(inverted_index_filepath, query_without_file)
         else:
             process_queries(inverted_index_filepath, query_file)
     """
-    if arguments.query_without_file is not None:
+    filepaths = load_shards_manifest(arguments.inverted_index_filepath)
+    if filepaths is not None:
+        encoding = None
+        if arguments.query_without_file is not None:
+            queries = arguments.query_without_file
+        elif arguments.query_bytes_file is not None:
+            encoding, lines = iter_query_lines(arguments.query_bytes_file,
+                                               arguments.query_encoding)
+            queries = (line.split() for line in lines)
+        else:
+            queries = (line.strip().split() for line in arguments.query_file)
+        failed_shards = process_queries_sharded(filepaths, queries, arguments.shard_timeout,
+                                                encoding=encoding)
+        if len(failed_shards) == len(filepaths):
+            sys.exit("all shards failed, no results")
+    elif arguments.query_without_file is not None:
         process_queries_from_stdin(arguments.inverted_index_filepath,
                                    arguments.query_without_file)
+    elif arguments.query_bytes_file is not None:
+        process_queries_bytes(arguments.inverted_index_filepath,
+                              arguments.query_bytes_file,
+                              arguments.query_encoding)
     else:
         process_queries(arguments.inverted_index_filepath,
                         arguments.query_file)
@@ -387,6 +929,63 @@ def process_queries(inverted_index_filepath, query_file):
     sys.stdout.buffer.write(('\n'.join(relevant_ids)).encode())
 
 
+def process_queries_bytes(inverted_index_filepath, query_file, encoding="auto"):
+    """
+
+    Args:
+        inverted_index_filepath: filepath to InvertedIndex
+        query_file: binary file with queries
+        encoding: encoding of queries, "auto" to detect it
+
+    Returns:
+        None
+
+    Note:
+        words are split by ASCII whitespace only, so e.g. NBSP
+        (0xA0 in cp1251) is a part of a word here unlike in process_queries
+    """
+    print(f"read queries from {query_file}", file=sys.stderr)
+    inverted_index = InvertedIndex.load(inverted_index_filepath)
+    encoding, lines = iter_query_lines(query_file, encoding)
+    print(f"queries encoding is {encoding}", file=sys.stderr)
+    relevant_ids = []
+    for line in lines:
+        tmp_relevant_ids = inverted_index.query_bytes(line.split(), encoding)
+        tmp_relevant_ids = list(map(str, tmp_relevant_ids))
+        relevant_ids.append(','.join(tmp_relevant_ids))
+    sys.stdout.buffer.write(('\n'.join(relevant_ids)).encode())
+
+
+def process_queries_sharded(filepaths, queries, timeout=DEFAULT_SHARD_TIMEOUT,
+                            chunk_size=DEFAULT_SHARD_CHUNK_SIZE, encoding=None):
+    """
+
+    Args:
+        filepaths: filepaths of shards from the shards manifest
+        queries: iterable of lists of words, it is read lazily by chunks
+        timeout: seconds to wait for shards to answer one chunk
+        chunk_size: number of queries sent to shards at once
+        encoding: encoding of words if queries are lists of bytes, they are
+            matched without decoding as in process_queries_bytes
+
+    Returns:
+        list of filepaths of shards which failed or timed out
+    """
+    queries = iter(queries)
+    failed_shards = []
+    separator = b""
+    with ShardedInvertedIndex(filepaths, timeout=timeout, encoding=encoding) as sharded_inverted_index:
+        while True:
+            chunk = list(itertools.islice(queries, chunk_size))
+            if not chunk:
+                break
+            relevant_ids, failed_shards = sharded_inverted_index.query_many(chunk)
+            relevant_ids = [','.join(map(str, query_ids)) for query_ids in relevant_ids]
+            sys.stdout.buffer.write(separator + ('\n'.join(relevant_ids)).encode())
+            separator = b"\n"
+    return failed_shards
+
+
 def setup_parser(parser):
     """
 
@@ -414,6 +1013,11 @@ def setup_parser(parser):
         help="path to store inverted index in a binary format, \
              default path is %(default)s",
     )
+    build_parser.add_argument(
+        "--shards", dest="shards", type=positive_int, default=1,
+        help="number of shards partitioned by document id, query finds \
+             them through <output>.manifest",
+    )
     build_parser.set_defaults(callback=callback_build)
 
     query_parser = subparsers.add_parser(
@@ -431,21 +1035,38 @@ def setup_parser(parser):
     query_file_group.add_argument(
         "--query-file-utf8", dest="query_file",
         type=EncodedFileType("r", encoding="utf-8"),
-        default=TextIOWrapper(sys.stdin.buffer, encoding="utf-8"),
+        default="-",
         help="query file to get queries for inverted index",
     )
     query_file_group.add_argument(
         "--query-file-cp1251", dest="query_file",
         type=EncodedFileType("r", encoding="cp1251"),
-        default=TextIOWrapper(sys.stdin.buffer, encoding="cp1251"),
+        default="-",
         help="query file to get queries for inverted index",
     )
+    query_file_group.add_argument(
+        "--query-file", dest="query_bytes_file",
+        type=FileType("rb"),
+        help="query file in utf-8 or cp1251, processed as raw bytes, \
+             words are split by ASCII whitespace only",
+    )
+    query_parser.add_argument(
+        "--query-encoding", dest="query_encoding",
+        choices=("auto",) + QUERY_ENCODINGS, default="auto",
+        help="encoding of --query-file",
+    )
     query_parser.add_argument(
         "--query",
         nargs="+",
         action="append",
         dest="query_without_file",
     )
+    query_parser.add_argument(
+        "--shard-timeout", dest="shard_timeout", type=positive_float,
+        default=DEFAULT_SHARD_TIMEOUT,
+        help="seconds to wait for shards of a sharded index to answer \
+             a chunk of queries before returning partial results",
+    )
     query_parser.set_defaults(callback=callback_query)
 
 
@@ -1,5 +1,10 @@
 from textwrap import dedent
-from argparse import Namespace
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from io import BytesIO, TextIOWrapper
 
 import pytest
 
@@ -180,3 +185,329 @@ def test_can_dump_and_load_inverted_index(tmpdir, small_wikipedia_inverted_index
     assert small_wikipedia_inverted_index == loaded_inverted_index, (
         "load should return the same inverted index"
     )
+
+
+def test_setup_parser_opens_stdin_only_on_parse(monkeypatch):
+    parser = ArgumentParser()
+    task_Margasov_Arsenii_inverted_index.setup_parser(parser)
+    monkeypatch.setattr(sys, "stdin", TextIOWrapper(BytesIO("Кошка".encode("utf-8"))))
+    arguments = parser.parse_args(["query"])
+    assert arguments.query_file.encoding == "utf-8"
+    assert arguments.query_file.read() == "Кошка"
+
+
+@pytest.mark.parametrize(
+    "data, etalon_encoding",
+    [
+        pytest.param("Кошка dog".encode("utf-8"), "utf-8", id="utf-8"),
+        pytest.param("Кошка dog".encode("cp1251"), "cp1251", id="cp1251"),
+        pytest.param(b"dog", "utf-8", id="ascii"),
+    ],
+)
+def test_detect_encoding(data, etalon_encoding):
+    assert task_Margasov_Arsenii_inverted_index.detect_encoding(data) == etalon_encoding
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "cp1251"])
+def test_process_queries_bytes_matches_text_queries(tmpdir, capsys, encoding):
+    dataset_fio = tmpdir.join("dataset.txt")
+    dataset_fio.write_text("1\tКошка dog\n2\tкошка Кошка\n3\tdog\n", encoding="utf-8")
+    index_fio = tmpdir.join("index.dump")
+    task_Margasov_Arsenii_inverted_index.process_build(dataset_fio, index_fio)
+    queries_fio = tmpdir.join("queries.txt")
+    queries_fio.write_binary("Кошка\ndog\nКошка dog\nмышь\n".encode(encoding))
+    capsys.readouterr()
+    with open(queries_fio, "rb") as queries_fin:
+        task_Margasov_Arsenii_inverted_index.process_queries_bytes(index_fio, queries_fin)
+    captured = capsys.readouterr()
+    assert f"queries encoding is {encoding}" in captured.err
+    assert captured.out.split("\n") == ["1,2", "1,3", "1", ""]
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "cp1251"])
+def test_sharded_query_file_matches_process_queries_bytes(tmpdir, capsys, encoding):
+    dataset_fio = tmpdir.join("dataset.txt")
+    dataset_fio.write_text("1\tКошка dog\n2\tкошка Кошка\n3\tdog\n", encoding="utf-8")
+    queries_fio = tmpdir.join("queries.txt")
+    queries_fio.write_binary("Кошка\ndog\nКошка\xa0dog\nмышь\n".encode(encoding))
+    parser = ArgumentParser()
+    task_Margasov_Arsenii_inverted_index.setup_parser(parser)
+    answers = []
+    for shards_count in (1, 2):
+        index_fio = tmpdir.join(f"index{shards_count}.dump")
+        task_Margasov_Arsenii_inverted_index.process_build(dataset_fio, index_fio, shards_count=shards_count)
+        arguments = parser.parse_args(["query", "-i", str(index_fio), "--query-file", str(queries_fio)])
+        capsys.readouterr()
+        arguments.callback(arguments)
+        arguments.query_bytes_file.close()
+        answers.append([sorted(answer.split(",")) for answer in capsys.readouterr().out.split("\n")])
+    assert answers[0] == answers[1] == [["1", "2"], ["1", "3"], [""], [""]]
+
+
+def test_build_sharded_inverted_index_partitions_by_document_id(tiny_dataset_fio):
+    documents = task_Margasov_Arsenii_inverted_index.load_documents(tiny_dataset_fio)
+    shards = task_Margasov_Arsenii_inverted_index.build_sharded_inverted_index(documents, 2)
+    assert sorted(shards[0].query(["some"])) == [2]
+    assert sorted(shards[1].query(["some"])) == [123]
+    assert sorted(shards[1].query(["A_word"])) == [37, 123]
+
+
+def test_sharded_inverted_index_merges_shards(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=3)
+    filepaths = task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio)
+    queries = [["A_word"], ["some"], ["A_word", "B_word"], ["word_does_not_exist"]]
+    with task_Margasov_Arsenii_inverted_index.ShardedInvertedIndex(filepaths) as sharded_index:
+        relevant_ids, failed_shards = sharded_index.query_many(queries)
+    assert failed_shards == []
+    assert list(map(sorted, relevant_ids)) == [[37, 123], [2, 123], [37], []]
+
+
+def test_sharded_inverted_index_returns_partial_result(tmpdir, tiny_dataset_fio, capsys):
+    index_fio = tmpdir.join("index.dump")
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=2)
+    filepaths = task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio)
+    filepaths[1] = str(tmpdir.join("missing.dump"))
+    with task_Margasov_Arsenii_inverted_index.ShardedInvertedIndex(filepaths) as sharded_index:
+        relevant_ids, failed_shards = sharded_index.query_many([["some"]])
+    assert failed_shards == [filepaths[1]]
+    assert relevant_ids == [[2]]
+    assert "results are partial" in capsys.readouterr().err
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="needs named pipes")
+def test_sharded_inverted_index_returns_partial_result_on_timeout(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=2)
+    filepaths = task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio)
+    # opening a named pipe without writer blocks, so the shard hangs on load
+    # with any multiprocessing start method
+    os.unlink(filepaths[1])
+    os.mkfifo(filepaths[1])
+    start = time.monotonic()
+    with task_Margasov_Arsenii_inverted_index.ShardedInvertedIndex(filepaths, timeout=1.0) as sharded_index:
+        relevant_ids, failed_shards = sharded_index.query_many([["some"]])
+        assert sharded_index.query_many([["B_word"]]) == ([[2]], [filepaths[1]])
+    assert time.monotonic() - start < 30
+    assert failed_shards == [filepaths[1]]
+    assert relevant_ids == [[2]]
+
+
+def test_dump_writes_header_atomically(tmpdir, wikipedia_inverted_index):
+    index_fio = tmpdir.join("index.dump")
+    wikipedia_inverted_index.dump(index_fio)
+    assert index_fio.read_binary().startswith(task_Margasov_Arsenii_inverted_index.INDEX_MAGIC)
+    assert tmpdir.listdir() == [index_fio]
+
+
+@pytest.mark.parametrize("umask", [0o022, 0o077])
+def test_dump_respects_umask(tmpdir, wikipedia_inverted_index, umask):
+    index_fio = tmpdir.join("index.dump")
+    old_umask = os.umask(umask)
+    try:
+        wikipedia_inverted_index.dump(index_fio)
+    finally:
+        os.umask(old_umask)
+    assert os.stat(index_fio).st_mode & 0o777 == 0o666 & ~umask
+
+
+def test_can_load_inverted_index_without_header():
+    inverted_index = task_Margasov_Arsenii_inverted_index.InvertedIndex.load(SMALL_INVERTED_INDEX_STORE_PATH)
+    assert sorted(inverted_index.query(["in"])) == [6, 123]
+
+
+@pytest.mark.parametrize(
+    "damage",
+    [
+        pytest.param(lambda data: data[:-1], id="truncated"),
+        pytest.param(lambda data: data[:-1] + bytes([data[-1] ^ 1]), id="bit flip"),
+        pytest.param(lambda data: data[:6] + b"\x00\x09" + data[8:], id="version"),
+        pytest.param(lambda data: data[:10], id="truncated header"),
+    ],
+)
+def test_load_detects_corrupted_inverted_index(tmpdir, wikipedia_inverted_index, damage):
+    index_fio = tmpdir.join("index.dump")
+    wikipedia_inverted_index.dump(index_fio)
+    index_fio.write_binary(damage(index_fio.read_binary()))
+    with pytest.raises(task_Margasov_Arsenii_inverted_index.CorruptedIndexError):
+        task_Margasov_Arsenii_inverted_index.InvertedIndex.load(index_fio)
+
+
+def test_reloadable_inverted_index_swaps_index(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    documents = task_Margasov_Arsenii_inverted_index.load_documents(tiny_dataset_fio)
+    task_Margasov_Arsenii_inverted_index.build_inverted_index(documents).dump(index_fio)
+    reloadable_index = task_Margasov_Arsenii_inverted_index.ReloadableInvertedIndex(index_fio)
+    assert reloadable_index.reload_if_changed() is None
+
+    documents["7"] = "new A_word"
+    task_Margasov_Arsenii_inverted_index.build_inverted_index(documents).dump(index_fio)
+    reloadable_index.reload_if_changed().join()
+    assert sorted(reloadable_index.query(["A_word"])) == [7, 37, 123]
+
+    index_fio.write_binary(b"INVIDX broken")
+    reloadable_index.reload().join()
+    assert sorted(reloadable_index.query(["A_word"])) == [7, 37, 123]
+
+
+def test_reloadable_inverted_index_skips_failed_file_until_changed(tmpdir, tiny_dataset_fio, capsys):
+    index_fio = tmpdir.join("index.dump")
+    documents = task_Margasov_Arsenii_inverted_index.load_documents(tiny_dataset_fio)
+    task_Margasov_Arsenii_inverted_index.build_inverted_index(documents).dump(index_fio)
+    reloadable_index = task_Margasov_Arsenii_inverted_index.ReloadableInvertedIndex(index_fio)
+
+    index_fio.write_binary(b"INVIDX broken")
+    reloadable_index.reload_if_changed().join()
+    capsys.readouterr()
+    assert reloadable_index.reload_if_changed() is None
+    assert "reload of inverted index failed" not in capsys.readouterr().err
+
+    documents["7"] = "new A_word"
+    task_Margasov_Arsenii_inverted_index.build_inverted_index(documents).dump(index_fio)
+    reloadable_index.reload_if_changed().join()
+    assert sorted(reloadable_index.query(["A_word"])) == [7, 37, 123]
+
+    index_fio.remove()
+    assert reloadable_index.reload_if_changed() is None
+    assert sorted(reloadable_index.query(["A_word"])) == [7, 37, 123]
+
+
+def test_iter_query_lines_reads_lazily(monkeypatch):
+    monkeypatch.setattr(task_Margasov_Arsenii_inverted_index, "ENCODING_DETECTION_SAMPLE_SIZE", 8)
+    query_file = BytesIO("Кошка dog\nмышь\ncat\n".encode("cp1251") + b"x" * 100)
+    encoding, lines = task_Margasov_Arsenii_inverted_index.iter_query_lines(query_file)
+    assert encoding == "cp1251"
+    assert query_file.tell() == len("Кошка dog\n")
+    assert [line.decode(encoding).split() for line in lines] == [
+        ["Кошка", "dog"], ["мышь"], ["cat"], ["x" * 100],
+    ]
+
+
+def test_rebuild_replaces_shards_manifest(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=3)
+    old_filepaths = task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio)
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=2)
+    filepaths = task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio)
+    assert len(filepaths) == 2
+    assert not set(filepaths) & set(old_filepaths)
+    assert sorted(path.basename for path in tmpdir.listdir()) == sorted(
+        ["dataset.txt", "index.dump.manifest"] + [os.path.basename(path) for path in filepaths]
+    )
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio)
+    assert task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio) is None
+    assert sorted(path.basename for path in tmpdir.listdir()) == ["dataset.txt", "index.dump"]
+
+
+def test_failed_sharded_build_keeps_previous_shards(tmpdir, tiny_dataset_fio, monkeypatch):
+    index_fio = tmpdir.join("index.dump")
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=2)
+    old_filepaths = task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio)
+    old_listing = sorted(path.basename for path in tmpdir.listdir())
+
+    def failing_dump_shards_manifest(filepath, filepaths):
+        raise OSError("disk is full")
+
+    monkeypatch.setattr(task_Margasov_Arsenii_inverted_index, "dump_shards_manifest", failing_dump_shards_manifest)
+    with pytest.raises(OSError):
+        task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=2)
+    assert task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio) == old_filepaths
+    assert sorted(path.basename for path in tmpdir.listdir()) == old_listing
+
+
+def test_query_uses_shards_from_manifest(tmpdir, tiny_dataset_fio, capsys):
+    index_fio = tmpdir.join("index.dump")
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=3)
+    parser = ArgumentParser()
+    task_Margasov_Arsenii_inverted_index.setup_parser(parser)
+    arguments = parser.parse_args(["query", "-i", str(index_fio), "--query", "some"])
+    capsys.readouterr()
+    arguments.callback(arguments)
+    assert sorted(capsys.readouterr().out.split(",")) == ["123", "2"]
+
+
+@pytest.mark.parametrize("shards", ["0", "-1", "two"])
+def test_build_rejects_invalid_shards(shards, capsys):
+    parser = ArgumentParser()
+    task_Margasov_Arsenii_inverted_index.setup_parser(parser)
+    with pytest.raises(SystemExit):
+        parser.parse_args(["build", "--shards", shards])
+    assert "expected integer >= 1" in capsys.readouterr().err
+
+
+def test_failed_dump_keeps_old_index_and_no_temp_files(tmpdir, wikipedia_inverted_index, monkeypatch):
+    index_fio = tmpdir.join("index.dump")
+    wikipedia_inverted_index.dump(index_fio)
+    old_data = index_fio.read_binary()
+
+    def failing_fsync(fd):
+        raise OSError("disk is full")
+
+    monkeypatch.setattr(os, "fsync", failing_fsync)
+    with pytest.raises(OSError):
+        task_Margasov_Arsenii_inverted_index.InvertedIndex(term_doc_id={"new": {1}}).dump(index_fio)
+    assert tmpdir.listdir() == [index_fio]
+    assert index_fio.read_binary() == old_data
+
+
+def test_load_keeps_cause_of_corruption(tmpdir):
+    index_fio = tmpdir.join("index.dump")
+    index_fio.write_binary(b"\x00\x00\x00\x01\x00")
+    with pytest.raises(task_Margasov_Arsenii_inverted_index.CorruptedIndexError) as excinfo:
+        task_Margasov_Arsenii_inverted_index.InvertedIndex.load(index_fio)
+    assert excinfo.value.__cause__ is not None
+
+
+def test_startup_does_not_import_sharding_and_reload_modules():
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import task_Margasov_Arsenii_inverted_index"],
+        capture_output=True, text=True, check=True,
+    )
+    imports = {line.split("|")[2].strip() for line in completed.stderr.splitlines()[1:]}
+    for module in ("multiprocessing", "json", "tempfile", "threading"):
+        assert module not in imports
+
+
+def test_process_queries_sharded_sends_queries_by_chunks(tmpdir, tiny_dataset_fio, capsys, monkeypatch):
+    index_fio = tmpdir.join("index.dump")
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=2)
+    filepaths = task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio)
+    chunks = []
+    query_many = task_Margasov_Arsenii_inverted_index.ShardedInvertedIndex.query_many
+
+    def recording_query_many(self, queries):
+        chunks.append(len(queries))
+        return query_many(self, queries)
+
+    monkeypatch.setattr(task_Margasov_Arsenii_inverted_index.ShardedInvertedIndex, "query_many", recording_query_many)
+    capsys.readouterr()
+    queries = iter([["some"], ["B_word"], ["nothing"], ["to", "be"], ["some"]])
+    failed_shards = task_Margasov_Arsenii_inverted_index.process_queries_sharded(filepaths, queries, chunk_size=2)
+    assert failed_shards == []
+    assert chunks == [2, 2, 1]
+    answers = capsys.readouterr().out.split("\n")
+    assert [sorted(answer.split(",")) for answer in answers] == [
+        ["123", "2"], ["2", "37"], ["123"], ["5"], ["123", "2"],
+    ]
+
+
+def test_query_exits_with_error_when_all_shards_failed(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    task_Margasov_Arsenii_inverted_index.process_build(tiny_dataset_fio, index_fio, shards_count=2)
+    for filepath in task_Margasov_Arsenii_inverted_index.load_shards_manifest(index_fio):
+        os.unlink(filepath)
+    parser = ArgumentParser()
+    task_Margasov_Arsenii_inverted_index.setup_parser(parser)
+    arguments = parser.parse_args(["query", "-i", str(index_fio), "--query", "some"])
+    with pytest.raises(SystemExit) as excinfo:
+        arguments.callback(arguments)
+    assert excinfo.value.code == "all shards failed, no results"
+
+
+@pytest.mark.parametrize("shard_timeout", ["0", "-5", "nan", "soon"])
+def test_query_rejects_invalid_shard_timeout(shard_timeout, capsys):
+    parser = ArgumentParser()
+    task_Margasov_Arsenii_inverted_index.setup_parser(parser)
+    with pytest.raises(SystemExit):
+        parser.parse_args(["query", "--shard-timeout", shard_timeout])
+    assert "expected number > 0" in capsys.readouterr().err
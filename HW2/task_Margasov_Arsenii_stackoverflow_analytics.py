@@ -1,27 +1,291 @@
 #!/usr/bin/env python3
 """Stackoverflow analytics implemented here"""
+import atexit
 import csv
 import logging
 import logging.config
+import logging.handlers
+import queue
 import re
+import sys
 import json
+import os
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
 from collections import defaultdict
-
-import yaml
-import lxml.etree as et
+from functools import partial
 
 RE_SPLIT_PATTERN = r"\w+"
 APPLICATION_NAME = "stackoverflow_analytics"
 DEFAULT_LOGGING_CONFIG_FILEPATH = "logging.conf.yml"
+DEFAULT_LOGGING_CONFIG_CACHE_FILEPATH = "logging.conf.cache.json"
 DEFAULT_QUESTIONS_PATH = "./questions.xml"
 DEFAULT_STOP_WORDS_PATH = "./stop_words.txt"
 DEFAULT_QUERIES_PATH = "./queries.csv"
+DEFAULT_LOG_BATCH_SIZE = 256
+DEFAULT_OUTPUT_BUFFER_SIZE = 1 << 16
+OUTPUT_FORMATS = ("json", "ndjson")
+# logging module flags, see "Optimization" in logging HOWTO
+LOG_RECORD_ATTRIBUTE_FLAGS = {
+    "logThreads": ("thread",),
+    "logProcesses": ("process",),
+    "logMultiprocessing": ("processName",),
+    "_srcfile": ("pathname", "filename", "module", "lineno", "funcName"),
+}
 
 logger = logging.getLogger(APPLICATION_NAME)
 
 
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which leaves message formatting to the listener thread
+    when it is safe, i.e. all args of the record are immutable
+    """
+
+    IMMUTABLE_ARG_TYPES = (str, int, float, bool, bytes, type(None))
+
+    def prepare(self, record):
+        """
+
+        Args:
+            record: LogRecord to put into the queue
+
+        Returns:
+            the same LogRecord if its args can't change before the listener
+            formats them, otherwise the record formatted by QueueHandler
+        """
+        if (record.exc_info is None and isinstance(record.args, tuple)
+                and all(type(arg) in self.IMMUTABLE_ARG_TYPES for arg in record.args)):
+            return record
+        return super().prepare(record)
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener which writes records to stream handlers in batches,
+    subclasses like RotatingFileHandler go through their own emit
+    """
+
+    BATCHED_HANDLER_TYPES = (logging.StreamHandler, logging.FileHandler)
+
+    def __init__(self, log_queue, *handlers, batch_size: int = DEFAULT_LOG_BATCH_SIZE):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self._pending = {handler: [] for handler in handlers}
+        self._last_records = {}
+        self._pending_count = 0
+
+    def handle(self, record):
+        """
+
+        Args:
+            record: LogRecord taken from the queue
+
+        Returns:
+            None
+        """
+        record = self.prepare(record)
+        for handler in self.handlers:
+            if record.levelno < handler.level:
+                continue
+            if type(handler) in self.BATCHED_HANDLER_TYPES and handler.stream is not None:
+                if not handler.filter(record):
+                    continue
+                try:
+                    self._pending[handler].append(handler.format(record) + handler.terminator)
+                except Exception:
+                    handler.handleError(record)
+                    continue
+                self._last_records[handler] = record
+            else:
+                handler.handle(record)
+        self._pending_count += 1
+        if self._pending_count >= self.batch_size or self.queue.empty():
+            self.flush()
+
+    def flush(self):
+        """
+            Write all pending records with a single write per handler,
+            write errors are reported with handleError of the handler
+        Returns:
+            None
+        """
+        for handler, lines in self._pending.items():
+            if not lines:
+                continue
+            handler.acquire()
+            try:
+                handler.stream.write("".join(lines))
+                handler.stream.flush()
+            except Exception:
+                # report like Handler.emit does, so the listener thread keeps running
+                handler.handleError(self._last_records[handler])
+            finally:
+                handler.release()
+                lines.clear()
+        self._pending_count = 0
+
+    def stop(self):
+        """
+            Stop listener thread and write records left in the batch
+        Returns:
+            None
+        """
+        super().stop()
+        self.flush()
+
+
+def disable_unused_record_attributes(handlers):
+    """
+
+    Args:
+        handlers: handlers which are going to format records
+
+    Returns:
+        None, process wide logging flags are switched off for LogRecord
+        attributes which no formatter of handlers uses
+    """
+    formats = [getattr(handler.formatter, "_fmt", None) or "%(message)s" for handler in handlers]
+    for flag, attributes in LOG_RECORD_ATTRIBUTE_FLAGS.items():
+        if not any(attribute in fmt for fmt in formats for attribute in attributes):
+            setattr(logging, flag, None if flag == "_srcfile" else False)
+
+
+def setup_queued_logging(target_logger: logging.Logger,
+                         batch_size: int = DEFAULT_LOG_BATCH_SIZE) -> BatchQueueListener:
+    """
+
+    Args:
+        target_logger: logger whose handlers are moved behind a queue,
+            LogRecord attributes unused by their formatters are disabled
+        batch_size: max number of records written by listener at once
+
+    Returns:
+        started BatchQueueListener
+    """
+    handlers = list(target_logger.handlers)
+    disable_unused_record_attributes(handlers)
+    for handler in handlers:
+        target_logger.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    target_logger.addHandler(DeferredQueueHandler(log_queue))
+    listener = BatchQueueListener(log_queue, *handlers, batch_size=batch_size)
+    listener.start()
+    return listener
+
+
+class QueryResultWriter:
+    """
+    Serializes query results into a reusable buffer and writes it in large chunks
+    """
+
+    def __init__(self, stream=None, output_format: str = "json",
+                 buffer_size: int = DEFAULT_OUTPUT_BUFFER_SIZE):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"unknown output format {output_format!r}, "
+                             f"expected one of {OUTPUT_FORMATS}")
+        self.stream = stream if stream is not None else sys.stdout
+        self.buffer_size = buffer_size
+        self._buffer = bytearray()
+        if output_format == "ndjson":
+            try:
+                import orjson
+            except ImportError:
+                self._encode = self._encode_ndjson
+            else:
+                self._encode = partial(orjson.dumps, option=orjson.OPT_APPEND_NEWLINE)
+        else:
+            self._encode = self._encode_json
+
+    @staticmethod
+    def _encode_json(result: dict) -> bytes:
+        return json.dumps(result).encode() + b"\n"
+
+    @staticmethod
+    def _encode_ndjson(result: dict) -> bytes:
+        return json.dumps(result, separators=(",", ":"), ensure_ascii=False).encode() + b"\n"
+
+    def write(self, result: dict):
+        """
+
+        Args:
+            result: query answer to serialize
+
+        Returns:
+            None
+        """
+        self._buffer += self._encode(result)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+            Write buffered results into the stream
+        Returns:
+            None
+        """
+        if not self._buffer:
+            return
+        binary_stream = getattr(self.stream, "buffer", None)
+        if binary_stream is not None:
+            self.stream.flush()
+            binary_stream.write(self._buffer)
+            binary_stream.flush()
+        else:
+            self.stream.write(self._buffer.decode())
+            self.stream.flush()
+        del self._buffer[:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+
+class TitleTokenizer:
+    """
+    Precompiled title tokenizer which maps words to interned ids
+    """
+
+    def __init__(self, stop_words=(), pattern: str = RE_SPLIT_PATTERN):
+        self._findall = re.compile(pattern).findall
+        self.word_to_id = {}
+        self.id_to_word = []
+        self.stop_ids = frozenset(self.intern(word) for word in stop_words)
+
+    def intern(self, word: str) -> int:
+        """
+
+        Args:
+            word: word to intern
+
+        Returns:
+            id of the word
+        """
+        token_id = self.word_to_id.get(word)
+        if token_id is None:
+            token_id = len(self.id_to_word)
+            self.word_to_id[word] = token_id
+            self.id_to_word.append(word)
+        return token_id
+
+    def tokenize(self, title: str) -> tuple:
+        """
+
+        Args:
+            title: title of a question
+
+        Returns:
+            tuple of unique ids of title words without stop words
+        """
+        words = self._findall(title.lower())
+        token_ids = set(map(self.word_to_id.get, words))
+        if None in token_ids:
+            token_ids = set(map(self.intern, words))
+        return tuple(token_ids - self.stop_ids)
+
+
 def load_documents(filepath: str, encoding: str = "utf-8") -> list:
     """
 
@@ -42,20 +306,24 @@ def load_documents(filepath: str, encoding: str = "utf-8") -> list:
     return documents
 
 
-def process_arguments(quest_fp, stopwords_fp, queries_fp):
+def process_arguments(quest_fp, stopwords_fp, queries_fp, output_format="json"):
     """
 
     Args:
         quest_fp: filepath to questions
         stopwords_fp: filepath to stopwords
         queries_fp: filepath to queries
+        output_format: format of printed answers, one of OUTPUT_FORMATS
 
     Returns:
         dict of words and their scores
     """
+    import lxml.etree as et
+
     questions = load_documents(quest_fp)
     stop_words = set(load_documents(stopwords_fp, encoding="koi8-r"))
     queries = load_documents(queries_fp)
+    tokenizer = TitleTokenizer(stop_words)
     xml_lines = []
     for quest in questions:
         root = et.fromstring(quest)
@@ -65,31 +333,33 @@ def process_arguments(quest_fp, stopwords_fp, queries_fp):
                 continue
             score = int(root.xpath('@Score')[0])
             date = int(root.xpath('@CreationDate')[0][:4])
-            words = re.findall(RE_SPLIT_PATTERN, root.xpath('@Title')[0].lower())
+            words = tokenizer.tokenize(root.xpath('@Title')[0])
             if len(words) == 0:
                 continue
-            words = [word for word in words if word not in stop_words]
             xml_dict = {'words': words, 'date': date, 'score': score}
             xml_lines.append(xml_dict)
         except IndexError:
             continue
     logger.info("process XML dataset, ready to serve queries")
-    for query in queries:
-        words_scores = defaultdict(int)
-        from_date, to_date, amount = map(int, query)
-        logger.debug('got query "%s,%s,%s"', from_date, to_date, amount)
-        for xml_line in xml_lines:
-            if from_date <= xml_line['date'] <= to_date:
-                unique_words = set()
-                for word in xml_line['words']:
-                    if word not in unique_words:
-                        words_scores[word] += xml_line['score']
-                        unique_words.add(word)
-        words_scores = list(sorted(words_scores.items(), key=lambda kv: (-kv[1], kv[0])))[:amount]
-        if len(words_scores) < amount:
-            logger.warning('not enough data to answer, found %s words out of %s for period "%s,%s"', len(words_scores), amount, from_date, to_date)
-        out = {'start': from_date, 'end': to_date, 'top': words_scores}
-        print(json.dumps(out))
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    warning_enabled = logger.isEnabledFor(logging.WARNING)
+    with QueryResultWriter(output_format=output_format) as writer:
+        for query in queries:
+            words_scores = defaultdict(int)
+            from_date, to_date, amount = map(int, query)
+            if debug_enabled:
+                logger.debug('got query "%s,%s,%s"', from_date, to_date, amount)
+            for xml_line in xml_lines:
+                if from_date <= xml_line['date'] <= to_date:
+                    for token_id in xml_line['words']:
+                        words_scores[token_id] += xml_line['score']
+            words_scores = [(tokenizer.id_to_word[token_id], score)
+                            for token_id, score in words_scores.items()]
+            words_scores = list(sorted(words_scores, key=lambda kv: (-kv[1], kv[0])))[:amount]
+            if warning_enabled and len(words_scores) < amount:
+                logger.warning('not enough data to answer, found %s words out of %s for period "%s,%s"', len(words_scores), amount, from_date, to_date)
+            out = {'start': from_date, 'end': to_date, 'top': words_scores}
+            writer.write(out)
     logger.info("finish processing queries")
 
 
@@ -104,7 +374,8 @@ def callback_arguments(arguments):
     """
     process_arguments(arguments.questions_filepath,
                       arguments.stopwords_filepath,
-                      arguments.queries_filepath)
+                      arguments.queries_filepath,
+                      arguments.output_format)
 
 
 def setup_parser(parser):
@@ -134,17 +405,72 @@ def setup_parser(parser):
         help="path to read queries,\
          default path is %(default)s",
     )
+    parser.add_argument(
+        "--output-format", default="json",
+        choices=OUTPUT_FORMATS, dest="output_format",
+        help="format of printed answers, ndjson is compact,\
+         default format is %(default)s",
+    )
     parser.set_defaults(callback=callback_arguments)
 
 
-def setup_logging():
+def load_logging_config(config_filepath: str = DEFAULT_LOGGING_CONFIG_FILEPATH,
+                        cache_filepath: str = DEFAULT_LOGGING_CONFIG_CACHE_FILEPATH) -> dict:
+    """
+
+    Args:
+        config_filepath: path to YAML logging config
+        cache_filepath: path to JSON cache of parsed config
+
+    Returns:
+        dict config for logging.config.dictConfig
+    """
+    config_stat = os.stat(config_filepath)
+    config_key = [config_stat.st_mtime_ns, config_stat.st_size]
+    try:
+        with open(cache_filepath) as cache_fin:
+            cache = json.load(cache_fin)
+        if cache["key"] == config_key:
+            return cache["config"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    import tempfile
+    import yaml
+
+    with open(config_filepath) as config_fin:
+        config = yaml.safe_load(config_fin)
+    cache_dirpath = os.path.dirname(os.path.abspath(cache_filepath))
+    try:
+        cache_fd, tmp_filepath = tempfile.mkstemp(dir=cache_dirpath, suffix=".tmp")
+    except OSError:
+        return config
+    try:
+        with os.fdopen(cache_fd, "w") as cache_fout:
+            json.dump({"key": config_key, "config": config}, cache_fout)
+        # mkstemp creates 0600 file, give it the mode open() would
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_filepath, 0o666 & ~umask)
+        os.replace(tmp_filepath, cache_filepath)
+    except (OSError, TypeError):
+        os.unlink(tmp_filepath)
+    return config
+
+
+def setup_logging(config_filepath: str = DEFAULT_LOGGING_CONFIG_FILEPATH,
+                  cache_filepath: str = DEFAULT_LOGGING_CONFIG_CACHE_FILEPATH):
     """
         Setup logging
+    Args:
+        config_filepath: path to YAML logging config
+        cache_filepath: path to JSON cache of parsed config
+
     Returns:
         None
     """
-    with open(DEFAULT_LOGGING_CONFIG_FILEPATH) as config_fin:
-        logging.config.dictConfig(yaml.safe_load(config_fin))
+    logging.config.dictConfig(load_logging_config(config_filepath, cache_filepath))
+    listener = setup_queued_logging(logger)
+    atexit.register(listener.stop)
 
 
 def main():
@@ -1,5 +1,16 @@
+import io
+import json
+import logging
+import logging.handlers
+import os
+import re
+import subprocess
+import sys
+import timeit
+from collections import defaultdict
 from argparse import Namespace
 
+import lxml.etree
 import pytest
 
 import task_Margasov_Arsenii_stackoverflow_analytics
@@ -31,3 +42,339 @@ def test_process_arguments_correct_output(capsys):
     assert '{"start": 2019, "end": 2020, "top": [["better", 30], ["javascript", 20], ["python", 20], ["seo", 15]]}' in captured.out
 
 
+@pytest.fixture(autouse=True)
+def restore_logging_flags(monkeypatch):
+    for flag in task_Margasov_Arsenii_stackoverflow_analytics.LOG_RECORD_ATTRIBUTE_FLAGS:
+        monkeypatch.setattr(logging, flag, getattr(logging, flag))
+
+
+@pytest.fixture
+def file_logger(tmpdir):
+    test_logger = logging.getLogger("stackoverflow_analytics_test")
+    test_logger.setLevel(logging.DEBUG)
+    test_logger.propagate = False
+    log_fio = tmpdir.join("test.log")
+    file_handler = logging.FileHandler(log_fio)
+    file_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    test_logger.addHandler(file_handler)
+    yield test_logger, log_fio
+    # setup_queued_logging moves file_handler from the logger to its listener
+    for handler in list(test_logger.handlers):
+        test_logger.removeHandler(handler)
+        handler.close()
+    file_handler.close()
+
+
+def test_queued_logging_writes_all_records(file_logger):
+    test_logger, log_fio = file_logger
+    listener = task_Margasov_Arsenii_stackoverflow_analytics.setup_queued_logging(test_logger, batch_size=7)
+    for i in range(100):
+        test_logger.debug('got query "%s,%s,%s"', i, i, i)
+    listener.stop()
+    lines = log_fio.read().splitlines()
+    assert len(lines) == 100
+    assert lines[-1] == 'DEBUG: got query "99,99,99"'
+
+
+@pytest.fixture
+def many_queries_fio(tmpdir):
+    queries_fio = tmpdir.join("many_queries.csv")
+    queries_fio.write("2019,2019,2\n2019,2020,5\n" * 2500)
+    return queries_fio
+
+
+def test_queued_logging_process_arguments_benchmark(tmpdir, many_queries_fio, capsys, monkeypatch):
+    analytics_logger = task_Margasov_Arsenii_stackoverflow_analytics.logger
+    # pytest attaches its capturing handlers before the test, so it misses this logger
+    monkeypatch.setattr(analytics_logger, "propagate", False)
+    monkeypatch.setattr(analytics_logger, "level", logging.DEBUG)
+
+    logging_flags = {flag: getattr(logging, flag)
+                     for flag in task_Margasov_Arsenii_stackoverflow_analytics.LOG_RECORD_ATTRIBUTE_FLAGS}
+
+    def run_process_arguments(queued):
+        for flag, value in logging_flags.items():
+            setattr(logging, flag, value)
+        handler = logging.FileHandler(tmpdir.join("analytics.log"))
+        handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+        analytics_logger.addHandler(handler)
+        listener = None
+        if queued:
+            listener = task_Margasov_Arsenii_stackoverflow_analytics.setup_queued_logging(analytics_logger)
+        start = timeit.default_timer()
+        task_Margasov_Arsenii_stackoverflow_analytics.process_arguments(DEFAULT_QUESTIONS_PATH,
+                                                                        DEFAULT_STOP_WORDS_PATH,
+                                                                        str(many_queries_fio))
+        if listener is not None:
+            listener.stop()
+        elapsed = timeit.default_timer() - start
+        for attached_handler in list(analytics_logger.handlers):
+            analytics_logger.removeHandler(attached_handler)
+        handler.close()
+        capsys.readouterr()
+        return elapsed
+
+    # runs are interleaved, so load changes of the machine hit both modes
+    sync_times, queued_times = [], []
+    for _ in range(7):
+        sync_times.append(run_process_arguments(queued=False))
+        queued_times.append(run_process_arguments(queued=True))
+    sync_time, queued_time = min(sync_times), min(queued_times)
+    print(f"process_arguments with 5000 queries: sync logging {sync_time:.3f}s, "
+          f"queued logging {queued_time:.3f}s")
+    assert queued_time < sync_time
+
+
+def test_process_arguments_ndjson_output(capsys):
+    task_Margasov_Arsenii_stackoverflow_analytics.process_arguments(DEFAULT_QUESTIONS_PATH,
+                                                                    DEFAULT_STOP_WORDS_PATH,
+                                                                    DEFAULT_QUERIES_PATH,
+                                                                    output_format="ndjson")
+    captured = capsys.readouterr()
+    assert captured.out.splitlines() == [
+        '{"start":2019,"end":2019,"top":[["seo",15],["better",10]]}',
+        '{"start":2019,"end":2020,"top":[["better",30],["javascript",20],["python",20],["seo",15]]}',
+    ]
+
+
+def test_query_result_writer_flushes_in_chunks():
+    stream = io.BytesIO()
+    text_stream = io.TextIOWrapper(stream, encoding="utf-8")
+    writer = task_Margasov_Arsenii_stackoverflow_analytics.QueryResultWriter(text_stream, buffer_size=64)
+    out = {"start": 2019, "end": 2019, "top": [["seo", 15]]}
+    writer.write(out)
+    assert stream.getvalue() == b""
+    writer.write(out)
+    assert stream.getvalue().count(b"\n") == 2
+    writer.write(out)
+    writer.flush()
+    assert stream.getvalue().decode().splitlines() == [json.dumps(out)] * 3
+
+
+def test_query_result_writer_rejects_unknown_format():
+    with pytest.raises(ValueError):
+        task_Margasov_Arsenii_stackoverflow_analytics.QueryResultWriter(output_format="xml")
+
+
+def test_title_tokenizer_removes_stop_words_and_duplicates():
+    tokenizer = task_Margasov_Arsenii_stackoverflow_analytics.TitleTokenizer({"is", "the"})
+    token_ids = tokenizer.tokenize("What is the BEST way, the best?")
+    assert sorted(tokenizer.id_to_word[token_id] for token_id in token_ids) == ["best", "way", "what"]
+    assert sorted(token_ids) == sorted(tokenizer.tokenize("what best way"))
+
+
+@pytest.fixture
+def questions_titles():
+    titles = []
+    for quest in task_Margasov_Arsenii_stackoverflow_analytics.load_documents(DEFAULT_QUESTIONS_PATH):
+        titles.extend(lxml.etree.fromstring(quest).xpath('@Title'))
+    return titles
+
+
+def test_title_tokenizer_benchmark(questions_titles):
+    stop_words = set(task_Margasov_Arsenii_stackoverflow_analytics.load_documents(DEFAULT_STOP_WORDS_PATH,
+                                                                                   encoding="koi8-r"))
+    tokenizer = task_Margasov_Arsenii_stackoverflow_analytics.TitleTokenizer(stop_words)
+    titles = questions_titles * 10000
+
+    def tokenize_with_findall():
+        for title in titles:
+            words = re.findall(task_Margasov_Arsenii_stackoverflow_analytics.RE_SPLIT_PATTERN, title.lower())
+            [word for word in words if word not in stop_words]
+
+    def tokenize_with_tokenizer():
+        for title in titles:
+            tokenizer.tokenize(title)
+
+    findall_time = min(timeit.repeat(tokenize_with_findall, number=1, repeat=5))
+    tokenizer_time = min(timeit.repeat(tokenize_with_tokenizer, number=1, repeat=5))
+    print(f"tokenizing {len(titles)} titles: findall {findall_time:.3f}s, "
+          f"TitleTokenizer {tokenizer_time:.3f}s")
+    # tokenize also deduplicates and interns, it is expected to be on par with findall
+    assert tokenizer_time < 1.5 * findall_time
+
+
+def reference_process_arguments(quest_fp, stopwords_fp, queries_fp):
+    """process_arguments before TitleTokenizer, answers are returned instead of printed"""
+    questions = task_Margasov_Arsenii_stackoverflow_analytics.load_documents(quest_fp)
+    stop_words = set(task_Margasov_Arsenii_stackoverflow_analytics.load_documents(stopwords_fp, encoding="koi8-r"))
+    queries = task_Margasov_Arsenii_stackoverflow_analytics.load_documents(queries_fp)
+    xml_lines = []
+    for quest in questions:
+        root = lxml.etree.fromstring(quest)
+        if int(root.xpath('@PostTypeId')[0]) != 1:
+            continue
+        words = re.findall(task_Margasov_Arsenii_stackoverflow_analytics.RE_SPLIT_PATTERN,
+                           root.xpath('@Title')[0].lower())
+        words = [word for word in words if word not in stop_words]
+        xml_lines.append({'words': words, 'date': int(root.xpath('@CreationDate')[0][:4]),
+                          'score': int(root.xpath('@Score')[0])})
+    answers = []
+    for query in queries:
+        words_scores = defaultdict(int)
+        from_date, to_date, amount = map(int, query)
+        for xml_line in xml_lines:
+            if from_date <= xml_line['date'] <= to_date:
+                unique_words = set()
+                for word in xml_line['words']:
+                    if word not in unique_words:
+                        words_scores[word] += xml_line['score']
+                        unique_words.add(word)
+        words_scores = list(sorted(words_scores.items(), key=lambda kv: (-kv[1], kv[0])))[:amount]
+        answers.append(json.dumps({'start': from_date, 'end': to_date, 'top': words_scores}))
+    return answers
+
+
+def test_process_arguments_tokenizer_benchmark(tmpdir, capsys):
+    with open(DEFAULT_QUESTIONS_PATH) as questions_fin:
+        questions = questions_fin.read().splitlines()
+    questions_fio = tmpdir.join("questions.xml")
+    questions_fio.write("\n".join(questions * 700) + "\n")
+    queries_fio = tmpdir.join("queries.csv")
+    queries_fio.write("2019,2019,2\n2019,2020,5\n" * 50)
+    args = (str(questions_fio), DEFAULT_STOP_WORDS_PATH, str(queries_fio))
+
+    def run_process_arguments():
+        task_Margasov_Arsenii_stackoverflow_analytics.process_arguments(*args)
+
+    reference_time = min(timeit.repeat(lambda: reference_process_arguments(*args), number=1, repeat=3))
+    capsys.readouterr()
+    process_time = min(timeit.repeat(run_process_arguments, number=1, repeat=3))
+    answers = capsys.readouterr().out.splitlines()
+    print(f"process_arguments over {len(questions) * 700} questions and 100 queries: "
+          f"findall {reference_time:.3f}s, TitleTokenizer {process_time:.3f}s")
+    assert answers == reference_process_arguments(*args) * 3
+    assert process_time < reference_time
+
+
+def test_load_logging_config_uses_cache(tmpdir):
+    config_fio = tmpdir.join("logging.conf.yml")
+    config_fio.write("version: 1\nroot:\n  level: INFO\n")
+    cache_fio = tmpdir.join("logging.conf.cache.json")
+    config = task_Margasov_Arsenii_stackoverflow_analytics.load_logging_config(config_fio, cache_fio)
+    assert config == {"version": 1, "root": {"level": "INFO"}}
+    assert json.loads(cache_fio.read())["config"] == config
+    cache = json.loads(cache_fio.read())
+    cache["config"]["root"]["level"] = "DEBUG"
+    cache_fio.write(json.dumps(cache))
+    cached_config = task_Margasov_Arsenii_stackoverflow_analytics.load_logging_config(config_fio, cache_fio)
+    assert cached_config == {"version": 1, "root": {"level": "DEBUG"}}
+    assert sorted(path.basename for path in tmpdir.listdir()) == ["logging.conf.cache.json", "logging.conf.yml"]
+
+
+def test_load_logging_config_cache_respects_umask(tmpdir):
+    config_fio = tmpdir.join("logging.conf.yml")
+    config_fio.write("version: 1\n")
+    cache_fio = tmpdir.join("logging.conf.cache.json")
+    old_umask = os.umask(0o022)
+    try:
+        task_Margasov_Arsenii_stackoverflow_analytics.load_logging_config(config_fio, cache_fio)
+    finally:
+        os.umask(old_umask)
+    assert os.stat(cache_fio).st_mode & 0o777 == 0o644
+
+
+def test_startup_importtime_benchmark():
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import task_Margasov_Arsenii_stackoverflow_analytics"],
+        capture_output=True, text=True, check=True,
+    )
+    imports = {}
+    for line in completed.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        imports[name.strip()] = int(cumulative)
+    startup_time = imports["task_Margasov_Arsenii_stackoverflow_analytics"]
+    print(f"import task_Margasov_Arsenii_stackoverflow_analytics: {startup_time} us")
+    assert "yaml" not in imports
+    assert "lxml.etree" not in imports
+    assert "tempfile" not in imports
+
+
+class BrokenStream(io.StringIO):
+    def write(self, text):
+        raise OSError("disk is full")
+
+
+def test_queued_logging_survives_handler_errors(tmpdir, monkeypatch):
+    # logger outside of logging manager, so pytest doesn't attach its handlers
+    test_logger = logging.Logger("stackoverflow_analytics_isolated")
+    log_fio = tmpdir.join("test.log")
+    file_handler = logging.FileHandler(log_fio)
+    broken_handler = logging.StreamHandler(BrokenStream())
+    test_logger.addHandler(file_handler)
+    test_logger.addHandler(broken_handler)
+    handled_errors = []
+    monkeypatch.setattr(broken_handler, "handleError", handled_errors.append)
+    monkeypatch.setattr(file_handler, "handleError", handled_errors.append)
+    listener = task_Margasov_Arsenii_stackoverflow_analytics.setup_queued_logging(test_logger, batch_size=7)
+    for i in range(20):
+        test_logger.warning('got query "%s,%s,%s"', i, i, i)
+    test_logger.warning("%d", "not a number")
+    test_logger.warning("last")
+    listener.stop()
+    file_handler.close()
+    lines = log_fio.read().splitlines()
+    assert len(lines) == 21
+    assert lines[-1] == "last"
+    assert len(handled_errors) > 2
+
+
+NDJSON_RESULT = {"start": 2019, "end": 2019, "top": [["кошка", 15]]}
+NDJSON_ETALON = '{"start":2019,"end":2019,"top":[["кошка",15]]}\n'.encode("utf-8")
+
+
+def ndjson_encode(result):
+    stream = io.BytesIO()
+    with task_Margasov_Arsenii_stackoverflow_analytics.QueryResultWriter(
+            io.TextIOWrapper(stream, encoding="utf-8"), output_format="ndjson") as writer:
+        writer.write(result)
+    return stream.getvalue()
+
+
+def test_query_result_writer_ndjson_with_orjson():
+    pytest.importorskip("orjson")
+    assert ndjson_encode(NDJSON_RESULT) == NDJSON_ETALON
+
+
+def test_query_result_writer_ndjson_without_orjson(monkeypatch):
+    monkeypatch.setitem(sys.modules, "orjson", None)
+    assert ndjson_encode(NDJSON_RESULT) == NDJSON_ETALON
+
+
+def test_process_arguments_writes_answers_before_bad_query(tmpdir, capsys):
+    queries_fio = tmpdir.join("queries.csv")
+    queries_fio.write("2019,2019,2\nbad,2019,2\n")
+    with pytest.raises(ValueError):
+        task_Margasov_Arsenii_stackoverflow_analytics.process_arguments(DEFAULT_QUESTIONS_PATH,
+                                                                        DEFAULT_STOP_WORDS_PATH,
+                                                                        str(queries_fio))
+    captured = capsys.readouterr()
+    assert captured.out == '{"start": 2019, "end": 2019, "top": [["seo", 15], ["better", 10]]}\n'
+
+
+def test_queued_logging_keeps_rotating_handler_rollover(tmpdir):
+    test_logger = logging.Logger("stackoverflow_analytics_isolated")
+    log_fio = tmpdir.join("test.log")
+    handler = logging.handlers.RotatingFileHandler(log_fio, maxBytes=200, backupCount=1)
+    test_logger.addHandler(handler)
+    listener = task_Margasov_Arsenii_stackoverflow_analytics.setup_queued_logging(test_logger)
+    for i in range(100):
+        test_logger.warning('got query "%s,%s,%s"', i, i, i)
+    listener.stop()
+    handler.close()
+    assert log_fio.size() <= 200
+    assert tmpdir.join("test.log.1").exists()
+
+
+def test_queued_logging_formats_mutable_args_eagerly(tmpdir):
+    test_logger = logging.Logger("stackoverflow_analytics_isolated")
+    log_fio = tmpdir.join("test.log")
+    handler = logging.FileHandler(log_fio)
+    test_logger.addHandler(handler)
+    listener = task_Margasov_Arsenii_stackoverflow_analytics.setup_queued_logging(test_logger)
+    words = ["seo"]
+    test_logger.warning("words %s", words)
+    words.append("python")
+    listener.stop()
+    handler.close()
+    assert log_fio.read() == "words ['seo']\n"